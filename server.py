@@ -1,9 +1,26 @@
+import asyncio
+import functools
+import hashlib
 import os
-from typing import Annotated
-from datetime import datetime
-from fastmcp import FastMCP
-from openai import OpenAI
-from pydantic import BaseModel
+import re
+import time
+from collections.abc import Iterator
+from typing import Annotated, Literal, TypeVar
+from datetime import datetime, timezone
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
+from fastmcp import Context, FastMCP
+import httpx
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
+import orjson
+from pydantic import BaseModel, ConfigDict
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 mcp = FastMCP(
     name="decomposition",
@@ -14,33 +31,59 @@ dependencies needed to answer the main question. Use the `decompose_question` to
 )
 
 
+# Bump whenever the prompts or the cached value format change so stale cache entries are invalidated.
+SYSTEM_VERSION = "5"
+_CACHE_TTL = 7 * 24 * 60 * 60
+
+_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "500000"))
+
+
+# Models are sent as strict JSON schemas, which require additionalProperties to be false.
 class SubSubquestion(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
     question: str
 
 class Subqestion(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
     subquestions: list[SubSubquestion]
     question: str
     
-class DecompositionResult(BaseModel):
-    original_question: str
-    subquestions: list[Subqestion]
+class Outline(BaseModel):
+    model_config = ConfigDict(extra="forbid")
 
+    subquestions: list[str]
 
-@mcp.tool(
-    name="decompose_question",
-    title="Decompose Forecasting Question",
-    description="Decomposes a forecasting question into simpler subquestions that can be forecasted independently.",
-    tags={"backtesting_supported"},
-    exclude_args=["cutoff_date"],
-)
-def decompose_question(
-    question: Annotated[str, "The forecasting question to decompose"],
-    context: Annotated[str, "Optional additional context about the question"] = "",
-    cutoff_date: Annotated[str, "The date must be in the format YYYY-MM-DD"] = datetime.now().strftime("%Y-%m-%d"),
-) -> str:
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+class BatchFillResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    results: list[Subqestion]
+
+class ComplexityScore(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    tier: Literal["low", "medium", "high"]
 
-    system_prompt = f"""Break down a forecasting question into subquestions for downstream forecasters. Do not formulate them as research questions of historic facts but only forward-looking. Questions on the same level should be as independent as possible (avoid strong correlation).
+
+ParsedT = TypeVar("ParsedT", bound=BaseModel)
+Effort = Literal["low", "medium", "high"]
+
+# Phrases that signal nested or conditional structure; questions containing any skip the low-effort shortcut.
+_CLAUSE_MARKERS = (",", ";", " if ", " unless ", " conditional on ", " given ", " provided ", " while ", " whereas ")
+# The comma in dates like "March 1, 2026" doesn't start a clause.
+_DATE_COMMA = re.compile(r"(?<=\d),(?=\s*\d{4}\b)")
+
+_RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+# A timed-out call has already waited out the full read timeout, so retrying it could hold the tool for most of an hour.
+_RETRY = retry_if_exception_type(_RETRYABLE_ERRORS) & retry_if_not_exception_type(APITimeoutError)
+_RETRY_WAIT = wait_random_exponential(multiplier=1, max=30)
+
+
+# Kept byte-identical across calls so the API can serve it from its prompt cache.
+_SYSTEM_PROMPT = """Break down a forecasting question into subquestions for downstream forecasters. Do not formulate them as research questions of historic facts but only forward-looking. Questions on the same level should be as independent as possible (avoid strong correlation).
 
 <decomposition_strategies>
 Use these proven patterns to break complex questions into tractable subquestions. You can combine strategies.
@@ -126,24 +169,255 @@ Subquestion Decomposition:
 
 Output the subquestions as a nested list."""
 
-    user_prompt = f"""Question: {question}"""
+_COMPLEXITY_PROMPT = """Rate how much reasoning is needed to break down a forecasting question into subquestions.
+
+- low: a single actor, mechanism and time frame; a short flat list of subquestions is enough
+- medium: a few interacting drivers, phases or conditions
+- high: multiple stakeholders or causal mechanisms whose interactions need a deep nested decomposition"""
+
+
+class _TokenBucket:
+    """Tokens-per-minute governor. Calls reserve an estimate up front and settle it against actual usage afterwards."""
+
+    def __init__(self, tokens_per_minute: int) -> None:
+        self._capacity = tokens_per_minute
+        self._rate = tokens_per_minute / 60
+        self._level = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self._capacity, self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self, estimate: int) -> None:
+        """Wait until the bucket is no longer overdrawn, then reserve ``estimate`` tokens."""
+        # Waiters queue on the lock and each reservation lowers the level for the next, so calls are spread out
+        # instead of all waking after the same sleep.
+        async with self._lock:
+            self._refill()
+            while self._level < 0:
+                await asyncio.sleep(-self._level / self._rate)
+                self._refill()
+            self._level -= estimate
+
+    def settle(self, estimate: int, used: int) -> None:
+        """Replace a reservation with the tokens the call actually used."""
+        self._refill()
+        self._level -= used - estimate
+
+
+_request_limiter = AsyncLimiter(OPENAI_RPM, 60)
+_token_bucket = _TokenBucket(OPENAI_TPM)
+
+
+@functools.cache
+def _get_client() -> AsyncOpenAI:
+    """Return the shared OpenAI client, created on first use so its connection pool is reused across calls."""
+    # Checked here rather than at import so the tool can still be registered and inspected without a key.
+    if not _API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        # Reasoning calls can run for minutes, so keep the SDK's default read timeout.
+        timeout=httpx.Timeout(600, connect=10),
+    )
+    # Retries are handled by _parse, so disable the SDK's own to avoid retrying twice.
+    return AsyncOpenAI(api_key=_API_KEY, http_client=http_client, max_retries=0)
+
+
+@functools.cache
+def _get_cache() -> Cache:
+    """Return the on-disk decomposition cache, created on first use so importing the module touches no files."""
+    return Cache(os.path.expanduser("~/.cache/mcp-decomposition"))
 
-    response = client.responses.parse(
-        model="gpt-5.2",
-        reasoning={"effort": "medium"},
-        input=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        text_format=DecompositionResult,
+
+def _cache_key(question: str, context: str, cutoff_date: str) -> str:
+    return hashlib.sha256(f"{SYSTEM_VERSION}|{cutoff_date}|{question}|{context}".encode()).hexdigest()
+
+
+@functools.cache
+def _text_format(text_format: type[BaseModel]) -> dict:
+    """Build the structured-output format for a model once, since schema generation walks the whole model."""
+    return {
+        "format": {
+            "type": "json_schema",
+            "name": text_format.__name__,
+            "schema": text_format.model_json_schema(),
+            "strict": True,
+        }
+    }
+
+
+def _check_response(response, text_format: type[BaseModel]) -> None:
+    """Raise a clear error for refusals and cut-off responses, which would otherwise surface as invalid JSON."""
+    if response.status in ("incomplete", "failed", "cancelled"):
+        reason = response.incomplete_details.reason if response.incomplete_details else response.status
+        raise RuntimeError(f"OpenAI response {response.status} ({reason}); no {text_format.__name__} was produced")
+    for item in response.output:
+        if item.type != "message":
+            continue
+        for content in item.content:
+            if content.type == "refusal":
+                raise RuntimeError(f"OpenAI refused to produce a {text_format.__name__}: {content.refusal}")
+
+
+async def _parse(
+    user_prompt: str,
+    text_format: type[ParsedT],
+    effort: Effort,
+    *,
+    model: str = "gpt-5.2",
+    system_prompt: str = _SYSTEM_PROMPT,
+) -> ParsedT:
+    async for attempt in AsyncRetrying(
+        retry=_RETRY,
+        wait=_RETRY_WAIT,
+        stop=stop_after_attempt(5),
+        reraise=True,
+    ):
+        with attempt:
+            # Roughly four characters per token; the reasoning and output tokens are settled after the call.
+            estimate = (len(system_prompt) + len(user_prompt)) // 4
+            await _token_bucket.acquire(estimate)
+            try:
+                async with _request_limiter:
+                    response = await _get_client().responses.create(
+                        model=model,
+                        reasoning={"effort": effort},
+                        input=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt},
+                        ],
+                        text=_text_format(text_format),
+                    )
+            except BaseException:
+                _token_bucket.settle(estimate, 0)
+                raise
+            _token_bucket.settle(estimate, response.usage.total_tokens if response.usage is not None else estimate)
+    _check_response(response, text_format)
+    return text_format.model_validate_json(response.output_text)
+
+
+def _is_simple(question: str) -> bool:
+    """Whether a question is short and flat enough to decompose at low effort without asking the router."""
+    padded = f" {_DATE_COMMA.sub('', question.lower())} "
+    return len(question.split()) < 15 and not any(marker in padded for marker in _CLAUSE_MARKERS)
+
+
+async def _choose_effort(question: str) -> Effort:
+    if _is_simple(question):
+        return "low"
+    score = await _parse(
+        f"Question: {question}", ComplexityScore, "low", model="gpt-5-mini", system_prompt=_COMPLEXITY_PROMPT
     )
+    return score.tier
+
+
+def _outline_prompt(question: str) -> str:
+    return f"""Question: {question}
+
+Only output the top-level subquestions; they will be broken down further in a separate step."""
+
+
+def _fill_prompt(question: str, subquestions: list[str]) -> str:
+    numbered = "\n".join(f"{i}. {sq}" for i, sq in enumerate(subquestions, 1))
+    return f"""Question: {question}
+
+Here are {len(subquestions)} top-level subquestions. For each of them, in the same order, break it down into its own subquestions and repeat the top-level subquestion verbatim as its question. Leave the list empty for a subquestion that cannot be usefully decomposed further.
+
+<subquestions>
+{numbered}
+</subquestions>"""
+
+
+def _normalize(question: str) -> str:
+    """Normalize a subquestion for memoization: lowercase, collapse whitespace, drop sentence-ending punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?.!… ")
+
+
+def _fill_cache_key(subquestion: str, cutoff_date: str) -> str:
+    return hashlib.sha256(f"fill|{SYSTEM_VERSION}|{cutoff_date}|{_normalize(subquestion)}".encode()).hexdigest()
+
+
+async def _fill(
+    question: str, subquestions: list[str], effort: Effort, cutoff_date: str
+) -> tuple[list[list[str]], bool]:
+    """Return the children of each top-level subquestion, in order, and whether every branch was filled."""
+    # Top-level subquestions recur across related questions, so reuse earlier breakdowns and only ask for the rest.
+    cache = _get_cache()
+    keys = [_fill_cache_key(sq, cutoff_date) for sq in subquestions]
+    children = {i: orjson.loads(cached) for i, key in enumerate(keys) if (cached := cache.get(key)) is not None}
+    misses = [i for i in range(len(subquestions)) if i not in children]
+    if misses:
+        batch = await _parse(_fill_prompt(question, [subquestions[i] for i in misses]), BatchFillResult, effort)
+        # Match results to parents by text rather than position, so a dropped or reordered result
+        # can't hand one branch its neighbour's children.
+        results = {_normalize(filled.question): k for k, filled in enumerate(batch.results)}
+        # A short or padded batch means the model lost track of the parents, so keep its results out of the memo.
+        full_batch = len(batch.results) == len(misses)
+        matched = set()
+        unmatched = []
+        for position, i in enumerate(misses):
+            if (k := results.get(_normalize(subquestions[i]))) is None:
+                unmatched.append((position, i))
+                continue
+            matched.add(k)
+            children[i] = [subsq.question for subsq in batch.results[k].subquestions]
+            if full_batch:
+                # Stored as orjson bytes, which diskcache writes as-is instead of pickling.
+                cache.set(keys[i], orjson.dumps(children[i]), expire=_CACHE_TTL)
+        # In a full batch a reworded parent's result still sits at its position. Use it for this answer, but
+        # don't memoize it, since the text can't confirm it belongs to this subquestion.
+        if full_batch:
+            for position, i in unmatched:
+                if position not in matched:
+                    children[i] = [subsq.question for subsq in batch.results[position].subquestions]
+    complete = len(children) == len(subquestions)
+    return [children.get(i, []) for i in range(len(subquestions))], complete
+
+
+def _render(subquestions: list[str], children: list[list[str]]) -> Iterator[str]:
+    for i, (sq, subsqs) in enumerate(zip(subquestions, children), 1):
+        yield f"{i}. {sq}"
+        for j, subsq in enumerate(subsqs, 1):
+            yield f"    {i}.{j}. {subsq}"
+
+
+@mcp.tool(
+    name="decompose_question",
+    title="Decompose Forecasting Question",
+    description="Decomposes a forecasting question into simpler subquestions that can be forecasted independently.",
+    tags={"backtesting_supported"},
+    exclude_args=["cutoff_date"],
+)
+async def decompose_question(
+    question: Annotated[str, "The forecasting question to decompose"],
+    context: Annotated[str, "Optional additional context about the question"] = "",
+    cutoff_date: Annotated[str | None, "The date must be in the format YYYY-MM-DD"] = None,
+    ctx: Context | None = None,
+) -> str:
+    if cutoff_date is None:
+        cutoff_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-    result = response.output_parsed
+    key = _cache_key(question, context, cutoff_date)
+    cached = _get_cache().get(key)
+    if cached is not None:
+        return cached
 
-    lines = []
-    for i, sq in enumerate(result.subquestions, 1):
-        lines.append(f"{i}. {sq.question}")
-        for j, subsq in enumerate(sq.subquestions, 1):
-            lines.append(f"    {i}.{j}. {subsq.question}")
+    effort = await _choose_effort(question)
+    outline = await _parse(_outline_prompt(question), Outline, effort)
+    if ctx is not None:
+        # Surface the top-level subquestions while the slower fill stage runs.
+        await ctx.report_progress(1, 2, "\n".join(f"{i}. {sq}" for i, sq in enumerate(outline.subquestions, 1)))
+    children, complete = await _fill(question, outline.subquestions, effort, cutoff_date)
+    if ctx is not None:
+        await ctx.report_progress(2, 2)
 
-    return "\n".join(lines)
\ No newline at end of file
+    out = "\n".join(_render(outline.subquestions, children))
+    # Don't pin a tree with missing branches for every re-ask; let the next call try again.
+    if complete:
+        _get_cache().set(key, out, expire=_CACHE_TTL)
+    return out
\ No newline at end of file
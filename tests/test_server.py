@@ -1,5 +1,29 @@
+import asyncio
 import inspect
-from server import decompose_question, mcp
+from types import SimpleNamespace
+
+import httpx
+import orjson
+import pytest
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
+from openai import APITimeoutError, BadRequestError, RateLimitError
+from tenacity import wait_none
+
+import server
+from server import (
+    BatchFillResult,
+    Outline,
+    SubSubquestion,
+    Subqestion,
+    _fill,
+    _fill_cache_key,
+    _is_simple,
+    _normalize,
+    _render,
+    decompose_question,
+    mcp,
+)
 
 
 class TestBacktestToolConfiguration:
@@ -39,6 +63,13 @@ class TestBacktestToolConfiguration:
             "cutoff_date parameter should have a default value"
         )
 
+    def test_backtest_tool_cutoff_date_default_is_resolved_per_call(self):
+        """cutoff_date must not default to a date frozen at import time."""
+        sig = inspect.signature(decompose_question.fn)
+        assert sig.parameters["cutoff_date"].default is None, (
+            "cutoff_date should default to None and be resolved to today's date when the tool runs"
+        )
+
 
 class TestAllToolsBacktestingConsistency:
     """Tests to ensure all tools in the server have consistent backtesting configuration."""
@@ -47,6 +78,13 @@ class TestAllToolsBacktestingConsistency:
         """Get all registered tools from the MCP server."""
         return mcp._tool_manager._tools
 
+    def test_only_decompose_question_is_registered(self):
+        """The server exposes exactly one tool, decompose_question."""
+        tools = self.get_all_tools()
+        assert list(tools) == ["decompose_question"], (
+            f"Expected only 'decompose_question' to be registered. Found tools: {list(tools)}"
+        )
+
     def test_all_backtest_tools_have_correct_configuration(self):
         """All tools with backtesting_supported tag must have cutoff_date properly configured."""
         tools = self.get_all_tools()
@@ -69,4 +107,308 @@ class TestAllToolsBacktestingConsistency:
                     f"Tool '{tool_name}' has backtesting_supported tag but "
                     f"'cutoff_date' is exposed in schema (should be excluded). "
                     f"Schema params: {list(schema_params)}"
-                )
\ No newline at end of file
+                )
+
+
+class TestRender:
+    """Tests for rendering a decomposition into the tool's text output."""
+
+    def test_render_numbers_nested_subquestions(self):
+        """Top-level subquestions are numbered N. and their children N.M."""
+        lines = _render(["A", "B"], [["A1", "A2"], []])
+        assert "\n".join(lines) == "1. A\n    1.1. A1\n    1.2. A2\n2. B"
+
+
+class TestEffortRouting:
+    """Tests for the heuristic that skips the complexity router."""
+
+    def test_short_flat_question_is_simple(self):
+        """Short questions without nested clauses go straight to low effort."""
+        assert _is_simple("Will the Fed cut rates before July 2026?")
+
+    def test_comma_in_date_does_not_count_as_a_clause(self):
+        """The comma in a date like "March 1, 2026" doesn't force the router."""
+        assert _is_simple("Will the Fed cut rates before March 1, 2026?")
+
+    def test_comma_between_clauses_is_not_simple(self):
+        """A comma outside a date still marks a nested clause."""
+        assert not _is_simple("Will the Fed cut rates, and will inflation fall?")
+
+    def test_conditional_question_is_not_simple(self):
+        """Conditional phrasing needs the router even when the question is short."""
+        assert not _is_simple("Will the Fed cut rates if inflation falls below 2%?")
+
+    def test_long_question_is_not_simple(self):
+        """Questions of 15 or more words need the router."""
+        question = "Will the unemployment rate for recent college graduates in the United States rise to 20% or more before 2028?"
+        assert not _is_simple(question)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """Point the server at an empty on-disk cache."""
+    cache = Cache(str(tmp_path))
+    monkeypatch.setattr(server, "_get_cache", lambda: cache)
+    yield cache
+    cache.close()
+
+
+def stub_parse(monkeypatch, responses):
+    """Replace _parse with a stub answering by text_format; returns the list of user prompts it received."""
+    prompts = []
+
+    async def _parse(user_prompt, text_format, effort, **kwargs):
+        prompts.append(user_prompt)
+        return responses[text_format]
+
+    monkeypatch.setattr(server, "_parse", _parse)
+    return prompts
+
+
+def branch(question, *children):
+    return Subqestion(question=question, subquestions=[SubSubquestion(question=c) for c in children])
+
+
+class TestFillMemo:
+    """Tests for memoizing subquestion breakdowns across questions."""
+
+    async def test_fill_only_requests_misses_and_splices_by_question(self, cache, monkeypatch):
+        """Memo hits are not re-requested, and batch results land on their parent even when reordered."""
+        cache.set(_fill_cache_key("B?", "2026-01-01"), orjson.dumps(["B1"]))
+        batch = BatchFillResult(results=[branch("C?", "C1"), branch("A?", "A1")])
+        prompts = stub_parse(monkeypatch, {BatchFillResult: batch})
+
+        children, complete = await _fill("Q?", ["A?", "B?", "C?"], "low", "2026-01-01")
+
+        assert len(prompts) == 1
+        assert "1. A?\n2. C?" in prompts[0] and "B?" not in prompts[0]
+        assert children == [["A1"], ["B1"], ["C1"]]
+        assert complete
+        assert orjson.loads(cache.get(_fill_cache_key("A?", "2026-01-01"))) == ["A1"]
+        assert orjson.loads(cache.get(_fill_cache_key("C?", "2026-01-01"))) == ["C1"]
+
+    async def test_fill_does_not_memoize_a_short_batch(self, cache, monkeypatch):
+        """A batch with missing results leaves those branches empty and writes nothing to the memo."""
+        stub_parse(monkeypatch, {BatchFillResult: BatchFillResult(results=[branch("A?", "A1")])})
+
+        children, complete = await _fill("Q?", ["A?", "B?"], "low", "2026-01-01")
+
+        assert children == [["A1"], []]
+        assert not complete
+        assert cache.get(_fill_cache_key("A?", "2026-01-01")) is None
+        assert cache.get(_fill_cache_key("B?", "2026-01-01")) is None
+
+    async def test_fill_falls_back_to_position_for_a_reworded_parent(self, cache, monkeypatch):
+        """In a full batch, a reworded parent takes the result at its position, which is not memoized."""
+        parent = "Will there be a US recession before 2028?"
+        batch = BatchFillResult(results=[branch("Will the US enter a recession before 2028?", "R1")])
+        stub_parse(monkeypatch, {BatchFillResult: batch})
+
+        children, complete = await _fill("Q?", [parent], "low", "2026-01-01")
+
+        assert children == [["R1"]]
+        assert complete
+        assert cache.get(_fill_cache_key(parent, "2026-01-01")) is None
+
+    async def test_fill_position_fallback_skips_results_matched_by_text(self, cache, monkeypatch):
+        """A result already matched to another parent by text is not reused for a reworded one."""
+        batch = BatchFillResult(results=[branch("B?", "B1"), branch("Something else?", "X1")])
+        stub_parse(monkeypatch, {BatchFillResult: batch})
+
+        children, complete = await _fill("Q?", ["A?", "B?"], "low", "2026-01-01")
+
+        assert children == [[], ["B1"]]
+        assert not complete
+
+    async def test_incomplete_decomposition_is_not_cached(self, cache, monkeypatch):
+        """The outline and fill stages are combined into the output, but a tree with gaps is not cached."""
+        prompts = stub_parse(
+            monkeypatch,
+            {
+                Outline: Outline(subquestions=["A?", "B?"]),
+                BatchFillResult: BatchFillResult(results=[branch("A?", "A1")]),
+            },
+        )
+
+        out = await decompose_question.fn("Will it rain?", cutoff_date="2026-01-01")
+
+        assert out == "1. A?\n    1.1. A1\n2. B?"
+        assert len(prompts) == 2
+        assert cache.get(server._cache_key("Will it rain?", "", "2026-01-01")) is None
+
+    def test_normalize_ignores_case_whitespace_and_trailing_punctuation(self):
+        """Trivially different phrasings of a subquestion share a memo entry."""
+        assert _normalize("Will there be a  US recession\nbefore 2028?") == "will there be a us recession before 2028"
+
+    def test_normalize_keeps_meaningful_trailing_characters(self):
+        """Only sentence-ending punctuation is stripped, so "3%?" and "3?" stay distinct."""
+        assert _normalize("Will inflation exceed 3%?") != _normalize("Will inflation exceed 3?")
+
+
+class TestAnswerCache:
+    """Tests for caching whole rendered decompositions."""
+
+    async def test_cache_hit_skips_the_api(self, cache, monkeypatch):
+        """A cached decomposition is returned as stored without calling the model."""
+        cache.set(server._cache_key("Will it rain?", "", "2026-01-01"), "1. Cached?")
+        prompts = stub_parse(monkeypatch, {})
+
+        out = await decompose_question.fn("Will it rain?", cutoff_date="2026-01-01")
+
+        assert out == "1. Cached?"
+        assert prompts == []
+
+    async def test_complete_decomposition_is_cached(self, cache, monkeypatch):
+        """A fully filled tree is written to the cache under the question's key."""
+        stub_parse(
+            monkeypatch,
+            {
+                Outline: Outline(subquestions=["A?", "B?"]),
+                BatchFillResult: BatchFillResult(results=[branch("A?", "A1"), branch("B?", "B1")]),
+            },
+        )
+
+        out = await decompose_question.fn("Will it rain?", cutoff_date="2026-01-01")
+
+        assert out == "1. A?\n    1.1. A1\n2. B?\n    2.1. B1"
+        assert cache.get(server._cache_key("Will it rain?", "", "2026-01-01")) == out
+
+
+
+_REQUEST = httpx.Request("POST", "https://api.openai.com/v1/responses")
+
+
+def api_error(error_type, status_code):
+    return error_type("error", response=httpx.Response(status_code, request=_REQUEST), body=None)
+
+
+def fake_response(output_text):
+    return SimpleNamespace(status="completed", usage=None, output_text=output_text, output=[], incomplete_details=None)
+
+
+def stub_client(monkeypatch, *outcomes):
+    """Replace the OpenAI client with one that raises or returns each outcome in turn; returns the call count."""
+    calls = []
+
+    async def create(**kwargs):
+        outcome = outcomes[len(calls)]
+        calls.append(kwargs)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(server, "_get_client", lambda: SimpleNamespace(responses=SimpleNamespace(create=create)))
+    monkeypatch.setattr(server, "_RETRY_WAIT", wait_none())
+    # Each test runs on its own event loop, which a shared AsyncLimiter warns about.
+    monkeypatch.setattr(server, "_request_limiter", AsyncLimiter(server.OPENAI_RPM, 60))
+    return calls
+
+
+class TestParseRetries:
+    """Tests for retrying transient OpenAI errors."""
+
+    async def test_rate_limit_is_retried(self, monkeypatch):
+        """A 429 is retried and the next successful response is parsed."""
+        calls = stub_client(monkeypatch, api_error(RateLimitError, 429), fake_response('{"subquestions": ["A?"]}'))
+
+        outline = await server._parse("Question: Q?", Outline, "low")
+
+        assert outline.subquestions == ["A?"]
+        assert len(calls) == 2
+
+    async def test_non_retryable_error_is_raised_at_once(self, monkeypatch):
+        """Errors outside the retryable set surface on the first attempt."""
+        calls = stub_client(monkeypatch, api_error(BadRequestError, 400), fake_response('{"subquestions": []}'))
+
+        with pytest.raises(BadRequestError):
+            await server._parse("Question: Q?", Outline, "low")
+        assert len(calls) == 1
+
+    async def test_timeout_is_not_retried(self, monkeypatch):
+        """A timed-out call is not retried, since it already waited out the full read timeout."""
+        calls = stub_client(monkeypatch, APITimeoutError(request=_REQUEST), fake_response('{"subquestions": []}'))
+
+        with pytest.raises(APITimeoutError):
+            await server._parse("Question: Q?", Outline, "low")
+        assert len(calls) == 1
+
+
+
+class TestParseResponseChecks:
+    """Tests for surfacing refusals and cut-off responses before validation."""
+
+    async def test_incomplete_response_raises_a_clear_error(self, monkeypatch):
+        """A response cut off by max_output_tokens is reported as such, not as invalid JSON."""
+        response = fake_response('{"subquestions": ["A')
+        response.status = "incomplete"
+        response.incomplete_details = SimpleNamespace(reason="max_output_tokens")
+        stub_client(monkeypatch, response)
+
+        with pytest.raises(RuntimeError, match="max_output_tokens"):
+            await server._parse("Question: Q?", Outline, "low")
+
+    async def test_refusal_raises_a_clear_error(self, monkeypatch):
+        """A refusal content item is reported with the model's explanation."""
+        response = fake_response("")
+        refusal = SimpleNamespace(type="refusal", refusal="I can't help with that.")
+        response.output = [SimpleNamespace(type="message", content=[refusal])]
+        stub_client(monkeypatch, response)
+
+        with pytest.raises(RuntimeError, match="refused.*I can't help with that"):
+            await server._parse("Question: Q?", Outline, "low")
+
+
+class TestTokenBucket:
+    """Tests for the tokens-per-minute governor."""
+
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        """Drive the bucket from a fake clock that asyncio.sleep advances; returns the list of sleep durations."""
+        now = [0.0]
+        sleeps = []
+        real_sleep = asyncio.sleep
+
+        async def fake_sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+            await real_sleep(0)
+
+        monkeypatch.setattr(server, "time", SimpleNamespace(monotonic=lambda: now[0]))
+        monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+        return now, sleeps
+
+    async def test_acquire_does_not_wait_while_tokens_remain(self, clock):
+        """A bucket with tokens left reserves without sleeping."""
+        _, sleeps = clock
+        bucket = server._TokenBucket(60)
+
+        await bucket.acquire(30)
+        await bucket.acquire(30)
+
+        assert sleeps == []
+
+    async def test_settle_debits_actual_usage_and_refill_is_capped(self, clock):
+        """Settling charges the difference from the estimate, and refill never exceeds capacity."""
+        now, _ = clock
+        bucket = server._TokenBucket(60)
+
+        await bucket.acquire(10)
+        bucket.settle(10, 50)
+        assert bucket._level == 10
+        now[0] += 30
+        bucket._refill()
+        assert bucket._level == 40
+        now[0] += 600
+        bucket._refill()
+        assert bucket._level == 60
+
+    async def test_overdrawn_waiters_are_spread_out(self, clock):
+        """Concurrent callers on an overdrawn bucket wait in turn for their own reservations."""
+        now, sleeps = clock
+        bucket = server._TokenBucket(60)
+        bucket.settle(0, 62)
+
+        await asyncio.gather(*(bucket.acquire(30) for _ in range(3)))
+
+        assert sleeps == [2.0, 30.0, 30.0]
+        assert now[0] == 62.0